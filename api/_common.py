@@ -0,0 +1,662 @@
+"""
+Shared helpers for the VIDNA API functions
+OpenRouter connection pooling, completion reading and filter parameter validation
+"""
+
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler
+import atexit
+import hashlib
+import http.client
+import io
+import json
+import math
+import os
+import sys
+import tempfile
+import threading
+import time
+from types import MappingProxyType
+import urllib.error
+from urllib.parse import urlsplit
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# OpenRouter API configuration
+API_URL = "https://openrouter.ai/api/v1/chat/completions"
+MODEL = "google/gemini-3-pro-preview"
+API_HOST = urlsplit(API_URL).hostname
+API_PATH = urlsplit(API_URL).path
+
+# Read once per container; handlers reject requests while it is missing or malformed
+API_KEY = os.environ.get("OPENROUTER_API_KEY") or ""
+if not API_KEY:
+    API_KEY_ERROR = "OPENROUTER_API_KEY not set in environment variables"
+elif len(API_KEY) < 10:
+    API_KEY_ERROR = f"API key appears invalid (length: {len(API_KEY)})"
+else:
+    API_KEY_ERROR = None
+if API_KEY_ERROR:
+    print(f"VIDNA: {API_KEY_ERROR}", file=sys.stderr)
+REQUEST_HEADERS = MappingProxyType({
+    "Content-Type": "application/json",
+    "Authorization": f"Bearer {API_KEY}",
+    "HTTP-Referer": "https://vidna.vercel.app",
+    "X-Title": "VIDNA - Photo Filter App"
+})
+
+# Seconds allowed for the TCP+TLS handshake, then for each read of the reply
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 120
+
+# Idle keep-alive connections to OpenRouter as (connection, last used) pairs, reused across warm invocations
+MAX_IDLE_CONNECTIONS = 16
+# Seconds after which an idle connection is assumed dropped upstream and discarded
+IDLE_EXPIRY = 60
+_idle_connections = []
+_pool_lock = threading.Lock()
+# Set while a background handshake is in progress so bursts start only one
+_prewarming = False
+
+# Largest request body accepted, and the chunk size it is read in
+MAX_BODY = 10 * 1024 * 1024
+READ_CHUNK = 64 * 1024
+
+# Upstream calls in progress, keyed by request cache key
+INFLIGHT_TIMEOUT = 150
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+# Parameter ranges for validation - expanded for more creative freedom
+RANGES = {
+    "brightness": {"min": 0.6, "max": 1.5},
+    "contrast": {"min": 0.6, "max": 1.5},
+    "saturation": {"min": 0.3, "max": 1.8},
+    "temperature": {"min": -40, "max": 40},
+    "tint": {"min": -25, "max": 25},
+    "grain": {"min": 0, "max": 0.4},
+    "vignette": {"min": 0, "max": 0.6},
+    "fade": {"min": 0, "max": 0.35}
+}
+
+# (field, default, decimal places) in response order; None rounds to an int
+FIELDS = (
+    ("brightness", 1.0, 2),
+    ("contrast", 1.0, 2),
+    ("saturation", 1.0, 2),
+    ("temperature", 0, None),
+    ("tint", 0, None),
+    ("grain", 0, 3),
+    ("vignette", 0, 2),
+    ("fade", 0, 3)
+)
+
+# FIELDS with each range's bounds and the midpoint used for non-numeric values
+CLAMP_TABLE = tuple(
+    (field, default, ndigits, RANGES[field]["min"], RANGES[field]["max"], (RANGES[field]["min"] + RANGES[field]["max"]) / 2)
+    for field, default, ndigits in FIELDS
+)
+
+# Neutral filter, also substituted for parameters missing from currentParams
+DEFAULT_PARAMS = {field: default for field, default, ndigits in FIELDS}
+
+
+if orjson is not None:
+    # orjson.JSONDecodeError subclasses json.JSONDecodeError, so handlers catch either
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+else:
+    json_loads = json.loads
+
+    def json_dumps(obj) -> bytes:
+        """Serialize to compact JSON bytes, escaping non-ASCII so lone surrogates survive"""
+        return json.dumps(obj, separators=(",", ":")).encode()
+
+
+# Per-request blocks of the vision and refine prompts, filled with format_map
+PARAMS_LIST_TEMPLATE = "\n".join(f"- {field}: {{{field}}}" for field, default, ndigits in FIELDS)
+PARAMS_JSON_TEMPLATE = "{{\n" + ",\n".join(f'  "{field}": {{{field}}}' for field, default, ndigits in FIELDS) + "\n}}"
+
+# JSON schema for structured outputs: the eight parameters, bounded by RANGES
+PARAMS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        field: {"type": "number" if ndigits else "integer", "minimum": low, "maximum": high}
+        for field, default, ndigits, low, high, middle in CLAMP_TABLE
+    },
+    "required": [field for field, default, ndigits in FIELDS],
+    "additionalProperties": False
+}
+
+
+def normalize_params(current_params: dict) -> dict:
+    """Fill in defaults for missing parameters and drop unknown keys, in field order"""
+    return {field: current_params.get(field, default) for field, default in DEFAULT_PARAMS.items()}
+
+
+def _to_float(value, default: float) -> float:
+    """Coerce a model-supplied value to a float, substituting default for NaN, infinity or non-numbers"""
+    try:
+        value = float(value)
+    except (TypeError, ValueError, OverflowError):
+        return default
+    return value if math.isfinite(value) else default
+
+
+def clamp_params(parsed: dict) -> dict:
+    """Clamp every filter parameter to its valid range and round it in one pass"""
+    return {
+        field: round(max(low, min(high, _to_float(parsed.get(field, default), middle))), ndigits)
+        for field, default, ndigits, low, high, middle in CLAMP_TABLE
+    }
+
+
+# Parses one complete value and reports where it ended, so trailing prose is ignored
+JSON_DECODER = json.JSONDecoder()
+
+
+def extract_json(response_text: str) -> dict:
+    """Extract the JSON object from a model response"""
+    if not response_text or not response_text.strip():
+        raise Exception("Empty response text received")
+    
+    # Decode from the first brace, skipping any markdown fences or commentary around the object
+    start = response_text.find("{")
+    if start == -1:
+        raise Exception(f"No JSON object found in response: {response_text[:500]}")
+    
+    # stdlib json also accepts NaN/Infinity, which clamping maps to the range midpoint
+    try:
+        return JSON_DECODER.raw_decode(response_text, start)[0]
+    except json.JSONDecodeError as e:
+        raise Exception(f"JSON parse error: {e}. Content: {response_text[start:start + 500]}")
+
+
+def parse_response(response_text: str) -> dict:
+    """Parse and validate GPT response"""
+    return clamp_params(extract_json(response_text))
+
+
+def cache_key(data, *values) -> str:
+    """Hash text or bytes, plus any extra values, into a compact cache key"""
+    # surrogatepass: client JSON may carry lone escaped surrogates, which plain UTF-8 rejects
+    digest = hashlib.blake2b(data.encode('utf-8', 'surrogatepass') if isinstance(data, str) else data, digest_size=16)
+    for value in values:
+        digest.update(f"|{value}".encode('utf-8', 'surrogatepass'))
+    return digest.hexdigest()
+
+
+def read_body(rfile, content_length: int) -> bytearray:
+    """Read a request body in chunks into a single preallocated buffer"""
+    body = bytearray(content_length)
+    with memoryview(body) as view:
+        received = 0
+        while received < content_length:
+            count = rfile.readinto(view[received:received + READ_CHUNK])
+            if not count:
+                break
+            received += count
+    
+    # Client closed early; return only what arrived
+    if received < content_length:
+        del body[received:]
+    return body
+
+
+class LRUCache:
+    """Thread-safe least-recently-used cache for results on a warm container"""
+    
+    __slots__ = ("max_size", "_entries", "_lock")
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        """Return the cached value (marking it recently used) or None"""
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: str, value):
+        """Store a value, evicting the least recently used past max_size"""
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+class DiskCache:
+    """JSON results kept in the temp directory so later cold starts on the same host reuse them"""
+    
+    __slots__ = ("directory", "ttl", "max_files", "_count")
+
+    def __init__(self, name: str, ttl: float, max_files: int):
+        self.directory = os.path.join(tempfile.gettempdir(), "vidna-cache", name)
+        self.ttl = ttl
+        self.max_files = max_files
+        # Files in the directory, counted on the first put and tracked after that
+        self._count = None
+
+    def get(self, key: str):
+        """Return the stored value, or None when missing, expired or unreadable"""
+        path = os.path.join(self.directory, f"{key}.json")
+        try:
+            # mtime is when the value was written; atime records the last hit for pruning
+            written = os.path.getmtime(path)
+            now = time.time()
+            if now - written > self.ttl:
+                return None
+            with open(path, "rb") as f:
+                value = json_loads(f.read())
+            os.utime(path, (now, written))
+            return value
+        except (OSError, ValueError):
+            return None
+
+    def put(self, key: str, value):
+        """Store a value, removing the least recently used files past max_files; failures are ignored"""
+        path = os.path.join(self.directory, f"{key}.json")
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            if self._count is None:
+                self._count = len(self._entries())
+            is_new = not os.path.exists(path)
+            with open(temp_path, "wb") as f:
+                f.write(json_dumps(value))
+            # Rename so readers never see a partly written file
+            os.replace(temp_path, path)
+            if is_new:
+                self._count += 1
+            if self._count > self.max_files:
+                self._prune()
+        except OSError:
+            pass
+
+    def _entries(self) -> list:
+        with os.scandir(self.directory) as it:
+            return [entry for entry in it if entry.name.endswith(".json")]
+
+    def _prune(self):
+        # Trim to 90% of the limit so the scan doesn't repeat on every following put
+        entries = self._entries()
+        keep = self.max_files * 9 // 10
+        if len(entries) > keep:
+            entries.sort(key=lambda entry: entry.stat().st_atime)
+            for entry in entries[:len(entries) - keep]:
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+        self._count = min(len(entries), keep)
+
+
+class _Flight:
+    """An upstream call that concurrent identical requests wait on"""
+    
+    __slots__ = ("done", "result", "error", "error_body")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.error_body = None
+
+    def raise_error(self):
+        """Re-raise the call's exception; an HTTPError gets a fresh copy of its one-shot body"""
+        e = self.error
+        if self.error_body is not None:
+            raise urllib.error.HTTPError(e.url, e.code, e.msg, e.hdrs, io.BytesIO(self.error_body))
+        raise e
+
+
+def coalesce(key: str, fn, *args):
+    """Run fn(*args) once per key at a time; concurrent callers share its result"""
+    with _inflight_lock:
+        flight = _inflight.get(key)
+        leader = flight is None
+        if leader:
+            flight = _inflight[key] = _Flight()
+    
+    if not leader:
+        if not flight.done.wait(INFLIGHT_TIMEOUT):
+            raise Exception("Timed out waiting for an identical request in progress")
+        if flight.error is not None:
+            flight.raise_error()
+        return flight.result
+    
+    try:
+        flight.result = fn(*args)
+        return flight.result
+    except Exception as e:
+        flight.error = e
+        if isinstance(e, urllib.error.HTTPError):
+            flight.error_body = e.read()
+            flight.raise_error()
+        raise
+    finally:
+        with _inflight_lock:
+            del _inflight[key]
+        flight.done.set()
+
+
+class OpenRouterConnection(http.client.HTTPSConnection):
+    """HTTPS connection that fails fast on connect but waits READ_TIMEOUT for the model"""
+
+    def __init__(self):
+        super().__init__(API_HOST, timeout=CONNECT_TIMEOUT)
+
+    def connect(self):
+        super().connect()
+        self.sock.settimeout(READ_TIMEOUT)
+
+
+def acquire_connection() -> http.client.HTTPSConnection:
+    """Take the most recently used idle connection from the pool, or open a new one"""
+    expired = []
+    with _pool_lock:
+        now = time.monotonic()
+        while _idle_connections:
+            conn, last_used = _idle_connections.pop()
+            if now - last_used < IDLE_EXPIRY:
+                break
+            expired.append(conn)
+        else:
+            conn = OpenRouterConnection()
+    for stale in expired:
+        stale.close()
+    return conn
+
+
+def _connect_idle():
+    """Open a connection and park it in the idle pool; failures are left to the real request"""
+    global _prewarming
+    conn = OpenRouterConnection()
+    try:
+        conn.connect()
+    except OSError:
+        conn.close()
+    else:
+        release_connection(conn)
+    finally:
+        with _pool_lock:
+            _prewarming = False
+
+
+def preconnect():
+    """Start the TCP+TLS handshake in the background when no idle connection is available"""
+    global _prewarming
+    with _pool_lock:
+        if _prewarming or (_idle_connections and time.monotonic() - _idle_connections[-1][1] < IDLE_EXPIRY):
+            return
+        _prewarming = True
+    threading.Thread(target=_connect_idle, daemon=True).start()
+
+
+def release_connection(conn: http.client.HTTPSConnection):
+    """Return a connection whose response was fully read to the idle pool"""
+    with _pool_lock:
+        if len(_idle_connections) < MAX_IDLE_CONNECTIONS:
+            _idle_connections.append((conn, time.monotonic()))
+            return
+    conn.close()
+
+
+@atexit.register
+def close_idle_connections():
+    """Close pooled connections when the container shuts down"""
+    with _pool_lock:
+        while _idle_connections:
+            _idle_connections.pop()[0].close()
+
+
+def open_openrouter(data: bytes, headers: dict) -> tuple:
+    """POST to OpenRouter on a pooled connection and return it with the unread response"""
+    conn = acquire_connection()
+    # Only a socket that was already open can have been dropped while idle
+    reused = conn.sock is not None
+    while True:
+        try:
+            conn.request("POST", API_PATH, body=data, headers=headers)
+            response = conn.getresponse()
+            break
+        except TimeoutError as e:
+            # A slow model is not a stale socket; resending would double the wait
+            conn.close()
+            raise urllib.error.URLError(e)
+        except (OSError, http.client.HTTPException) as e:
+            conn.close()
+            if not reused:
+                raise urllib.error.URLError(e)
+            # Idle keep-alive sockets may be dropped upstream between invocations; other
+            # pooled ones are likely stale too, so retry once on a fresh connection
+            conn = OpenRouterConnection()
+            reused = False
+    
+    if response.status >= 400:
+        error_body = response.read()
+        release_connection(conn)
+        raise urllib.error.HTTPError(API_URL, response.status, response.reason, response.headers, io.BytesIO(error_body))
+    
+    return conn, response
+
+
+def read_stream(conn: http.client.HTTPSConnection, response: http.client.HTTPResponse) -> str:
+    """Accumulate streamed content deltas until the JSON object is complete"""
+    try:
+        return _read_stream(conn, response)
+    except Exception:
+        # A half-read response leaves the connection unusable
+        conn.close()
+        raise
+
+
+def _read_stream(conn: http.client.HTTPSConnection, response: http.client.HTTPResponse) -> str:
+    content = []
+    reasoning = []
+    depth = 0
+    in_string = False
+    escaped = False
+    complete = False
+    
+    for line in response:
+        # Skip blank separators and ": OPENROUTER PROCESSING" keep-alive comments
+        if not line.startswith(b"data: "):
+            continue
+        payload = line[6:].strip()
+        if payload == b"[DONE]":
+            break
+        
+        event = json_loads(payload)
+        if "error" in event:
+            raise Exception(f"OpenRouter error: {event['error']}")
+        if not event.get("choices"):
+            continue
+        
+        delta = event["choices"][0].get("delta", {})
+        text = delta.get("content")
+        if text:
+            if complete:
+                if text.strip():
+                    # The model kept writing after the object closed; stop here
+                    conn.close()
+                    return "".join(content)
+                continue
+            content.append(text)
+            for char in text:
+                # Braces inside string values, e.g. a filter name, don't count
+                if in_string:
+                    if escaped:
+                        escaped = False
+                    elif char == "\\":
+                        escaped = True
+                    elif char == '"':
+                        in_string = False
+                elif char == '"':
+                    in_string = depth > 0
+                elif char == "{":
+                    depth += 1
+                elif char == "}" and depth > 0:
+                    depth -= 1
+                    complete = depth == 0
+        elif delta.get("reasoning"):
+            reasoning.append(delta["reasoning"])
+    
+    # Consume the end of the chunked body so the connection can be reused
+    response.read()
+    release_connection(conn)
+    
+    # For reasoning models, content might only be in the reasoning stream
+    return "".join(content) or "".join(reasoning)
+
+
+def request_completion(data: bytes) -> str:
+    """Send a serialized chat completion request and return the model's text"""
+    conn, response = open_openrouter(data, REQUEST_HEADERS)
+    
+    if response.getheader("Content-Type", "").startswith("text/event-stream"):
+        content = read_stream(conn, response)
+        if not content:
+            raise Exception("Empty content in streamed response")
+        return content
+    
+    # Buffered reply, e.g. when the provider ignores "stream"
+    response_body = response.read()
+    release_connection(conn)
+    result = json_loads(response_body)
+    
+    # Check for API errors in response
+    if "error" in result:
+        raise Exception(f"OpenRouter error: {result['error']}")
+    
+    if "choices" not in result or len(result["choices"]) == 0:
+        raise Exception(f"No choices in response: {response_body[:500].decode('utf-8', 'replace')}")
+    
+    message = result["choices"][0]["message"]
+    content = message.get("content", "")
+    
+    # For reasoning models, content might be in reasoning_details
+    if not content and "reasoning_details" in message:
+        reasoning = message.get("reasoning_details", [])
+        if reasoning and len(reasoning) > 0:
+            # Get the last reasoning block's content
+            content = reasoning[-1].get("content", "")
+    
+    # Also check for reasoning field directly
+    if not content and "reasoning" in message:
+        content = message.get("reasoning", "")
+    
+    if not content:
+        raise Exception(f"Empty content in response. Full response: {json.dumps(result)[:1000]}")
+    
+    return content
+
+
+class RequestError(Exception):
+    """A client error reported to the caller with its HTTP status code"""
+    
+    def __init__(self, status_code: int, message: str):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class BaseHandler(BaseHTTPRequestHandler):
+    """CORS, body parsing and error mapping shared by the API endpoints"""
+    
+    # API description returned to browser visits
+    INFO = {}
+    # Start the OpenRouter handshake before reading the body
+    PRECONNECT = False
+    # Largest request body accepted; endpoints without images override it
+    MAX_BODY = MAX_BODY
+    # Buffer the response so headers and body leave in one send; the server flushes after each request
+    wbufsize = -1
+    # CORS headers for every response, and the extra ones answering a preflight
+    ALLOW_ORIGIN = "*"
+    PREFLIGHT_HEADERS = (
+        ("Access-Control-Allow-Methods", "POST, OPTIONS"),
+        ("Access-Control-Allow-Headers", "Content-Type")
+    )
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # INFO never changes, so serialize it once when the endpoint class is defined
+        cls.INFO_BODY = json.dumps(cls.INFO, indent=2).encode()
+
+    def process(self, data: dict) -> dict:
+        """Handle a parsed POST body and return the success response"""
+        raise NotImplementedError
+
+    def do_GET(self):
+        """Return API info for browser visits"""
+        self.send_json_response(200, self.INFO_BODY)
+
+    def do_POST(self):
+        try:
+            # API key is validated once at import
+            if API_KEY_ERROR:
+                self.send_error_response(500, API_KEY_ERROR)
+                return
+            
+            if self.PRECONNECT:
+                preconnect()
+            
+            # Parse request body
+            content_length = int(self.headers.get("Content-Length", 0))
+            if content_length > self.MAX_BODY:
+                self.send_error_response(413, f"Request body too large (max {self.MAX_BODY} bytes)")
+                return
+            data = json_loads(read_body(self.rfile, content_length))
+            
+            # Send success response
+            self.send_json_response(200, json_dumps(self.process(data)))
+            
+        except RequestError as e:
+            self.send_error_response(e.status_code, str(e))
+        except urllib.error.HTTPError as e:
+            error_body = e.read().decode('utf-8')
+            try:
+                error_data = json_loads(error_body)
+                message = error_data.get("error", {}).get("message", str(e))
+            except:
+                message = f"HTTP {e.code}: {error_body[:200]}"
+            self.send_error_response(e.code, message)
+        except urllib.error.URLError as e:
+            self.send_error_response(500, f"Network error: {str(e)}")
+        except json.JSONDecodeError as e:
+            self.send_error_response(400, f"Invalid JSON: {str(e)}")
+        except Exception as e:
+            self.send_error_response(500, f"Server error: {str(e)}")
+    
+    def do_OPTIONS(self):
+        """Handle CORS preflight"""
+        self.send_response(200)
+        self.send_header("Access-Control-Allow-Origin", self.ALLOW_ORIGIN)
+        for name, value in self.PREFLIGHT_HEADERS:
+            self.send_header(name, value)
+        self.end_headers()
+    
+    def send_error_response(self, status_code: int, message: str):
+        self.send_json_response(status_code, json_dumps({"success": False, "error": message}))
+    
+    def send_json_response(self, status_code: int, body: bytes):
+        """Send a JSON body with an explicit Content-Length"""
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Access-Control-Allow-Origin", self.ALLOW_ORIGIN)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+# Handshake with OpenRouter while the container finishes starting, so the first request finds a warm socket
+if not API_KEY_ERROR:
+    preconnect()
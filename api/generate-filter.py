@@ -3,29 +3,24 @@ Generate Filter API - Vercel Serverless Function
 Creates filter parameters from quiz answers using GPT-4o via OpenRouter
 """
 
-from http.server import BaseHTTPRequestHandler
 import json
 import os
-import urllib.request
-import urllib.error
+import sys
 
-# OpenRouter API configuration
-API_URL = "https://openrouter.ai/api/v1/chat/completions"
-MODEL = "google/gemini-3-pro-preview"
+# Shared helpers live alongside the endpoints in api/_common.py
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from _common import MODEL, BaseHandler, LRUCache, RequestError, cache_key, clamp_params, coalesce, extract_json, json_dumps, request_completion
 
+# Filters already generated on this warm container, keyed by prompt hash
+CACHE = LRUCache(1024)
 
-def build_prompt(quiz_results: list, questions: list) -> str:
-    """Build the prompt for GPT - Plant Photography Specialist"""
-    
-    answer_summary = "\n".join([
-        f'Q{i+1}: "{q["text"]}" → "{next((opt["label"] for opt in q["options"] if opt["value"] == r["answer"]), r["answer"])}" ({next((opt["description"] for opt in q["options"] if opt["value"] == r["answer"]), "")})'
-        for i, (r, q) in enumerate(zip(quiz_results, questions))
-    ])
-    
-    return f"""You are an expert plant photography specialist. Based on the user's answers about their aesthetic preferences, create a great looking photo filter.
+# Static halves of the prompt; only the answer summary changes per request
+PROMPT_HEAD = """You are an expert plant photography specialist. Based on the user's answers about their aesthetic preferences, create a great looking photo filter.
 
 USER'S ANSWERS:
-{answer_summary}
+"""
+
+PROMPT_TAIL = """
 
 
 PARAMETERS (be creative, use the full range when appropriate):
@@ -62,7 +57,7 @@ Brightness: +20 to +30, Contrast: +10, Saturation: +10 to +15, Temperature: 0, T
 Generate a gentle 2-3 word name.
 
 Respond ONLY with valid JSON:
-{{
+{
   "name": "Filter Name",
   "brightness": 1.0,
   "contrast": 1.0,
@@ -72,211 +67,100 @@ Respond ONLY with valid JSON:
   "grain": 0,
   "vignette": 0,
   "fade": 0
-}}"""
-
-
-# Parameter ranges for validation - expanded for more creative freedom
-RANGES = {
-    "brightness": {"min": 0.6, "max": 1.5},
-    "contrast": {"min": 0.6, "max": 1.5},
-    "saturation": {"min": 0.3, "max": 1.8},
-    "temperature": {"min": -40, "max": 40},
-    "tint": {"min": -25, "max": 25},
-    "grain": {"min": 0, "max": 0.4},
-    "vignette": {"min": 0, "max": 0.6},
-    "fade": {"min": 0, "max": 0.35}
-}
+}"""
 
 
-def clamp_value(value, range_def):
-    """Clamp value to valid range"""
-    if not isinstance(value, (int, float)) or value != value:
-        return (range_def["min"] + range_def["max"]) / 2
-    return max(range_def["min"], min(range_def["max"], value))
-
-
-def parse_response(response_text: str) -> dict:
-    """Parse and validate GPT response"""
-    if not response_text or not response_text.strip():
-        raise Exception(f"Empty response text received")
-    
-    cleaned = response_text.strip()
-    if cleaned.startswith("```"):
-        cleaned = cleaned.replace("```json", "").replace("```", "").strip()
+def build_prompt(quiz_results: list, questions: list) -> str:
+    """Build the prompt for GPT - Plant Photography Specialist"""
     
-    # Try to extract JSON from the response if it contains other text
-    if not cleaned.startswith("{"):
-        # Look for JSON object in the response
-        start = cleaned.find("{")
-        end = cleaned.rfind("}") + 1
-        if start != -1 and end > start:
-            cleaned = cleaned[start:end]
+    lines = []
+    for i, (r, q) in enumerate(zip(quiz_results, questions)):
+        # Index options by value so each answer resolves in one lookup
+        options = {opt["value"]: opt for opt in q["options"]}
+        opt = options.get(r["answer"])
+        if opt:
+            lines.append(f'Q{i+1}: "{q["text"]}" → "{opt["label"]}" ({opt["description"]})')
         else:
-            raise Exception(f"No JSON object found in response: {response_text[:500]}")
+            lines.append(f'Q{i+1}: "{q["text"]}" → "{r["answer"]}" ()')
     
-    try:
-        parsed = json.loads(cleaned)
-    except json.JSONDecodeError as e:
-        raise Exception(f"JSON parse error: {e}. Content: {cleaned[:500]}")
-    
-    return {
-        "name": parsed.get("name", "Botanical Custom"),
-        "brightness": round(clamp_value(parsed.get("brightness", 1.0), RANGES["brightness"]), 2),
-        "contrast": round(clamp_value(parsed.get("contrast", 1.0), RANGES["contrast"]), 2),
-        "saturation": round(clamp_value(parsed.get("saturation", 1.0), RANGES["saturation"]), 2),
-        "temperature": round(clamp_value(parsed.get("temperature", 0), RANGES["temperature"])),
-        "tint": round(clamp_value(parsed.get("tint", 0), RANGES["tint"])),
-        "grain": round(clamp_value(parsed.get("grain", 0), RANGES["grain"]), 3),
-        "vignette": round(clamp_value(parsed.get("vignette", 0), RANGES["vignette"]), 2),
-        "fade": round(clamp_value(parsed.get("fade", 0), RANGES["fade"]), 3)
-    }
+    return PROMPT_HEAD + "\n".join(lines) + PROMPT_TAIL
 
 
-def call_openrouter(prompt: str, api_key: str) -> str:
-    """Call OpenRouter API using urllib (no external dependencies)"""
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {api_key}",
-        "HTTP-Referer": "https://vidna.vercel.app",
-        "X-Title": "VIDNA - Photo Filter App"
-    }
+def parse_response(response_text: str) -> dict:
+    """Parse and validate GPT response"""
+    parsed = extract_json(response_text)
+    return {"name": parsed.get("name", "Botanical Custom"), **clamp_params(parsed)}
+
+
+SYSTEM_PROMPT = "You are an expert plant photography color grading specialist. Create tasteful, cohesive filters. Always respond with valid JSON only, no markdown formatting."
+
+# Request body serialized once at import; the user prompt is spliced in at the null
+REQUEST_HEAD, REQUEST_TAIL = json.dumps({
+    "model": MODEL,
+    "messages": [
+        {
+            "role": "system",
+            "content": SYSTEM_PROMPT
+        },
+        {
+            "role": "user",
+            "content": None
+        }
+    ],
+    "temperature": 0.3,
+    "max_tokens": 500,
+    "provider": {
+        "sort": "latency"
+    },
+    "reasoning": {
+        "effort": "low"
+    },
+    "stream": True
+}).encode('utf-8').split(b"null")
+
+
+def call_openrouter(prompt: str) -> str:
+    """Call OpenRouter API over the pooled connection (no external dependencies)"""
+    data = REQUEST_HEAD + json_dumps(prompt) + REQUEST_TAIL
+    return request_completion(data)
+
+
+def generate_filter(prompt: str, key: str) -> dict:
+    """Call the model for a prompt and cache the validated filter"""
+    gpt_response = call_openrouter(prompt)
     
-    request_body = {
-        "model": MODEL,
-        "messages": [
-            {
-                "role": "system",
-                "content": "You are an expert plant photography color grading specialist. Create tasteful, cohesive filters. Always respond with valid JSON only, no markdown formatting."
-            },
-            {
-                "role": "user",
-                "content": prompt
-            }
-        ],
-        "temperature": 0.3,
-        "max_tokens": 500,
-        "reasoning": {
-            "effort": "low"
+    # Parse and validate response
+    filter_params = parse_response(gpt_response)
+    CACHE.put(key, filter_params)
+    return filter_params
+
+
+class handler(BaseHandler):
+    INFO = {
+        "endpoint": "/api/generate-filter",
+        "method": "POST",
+        "description": "Generate photo filter parameters from quiz answers",
+        "body": {
+            "quizResults": "[{questionId, answer}]",
+            "questions": "[{text, options: [{value, label, description}]}]"
         }
     }
-    
-    data = json.dumps(request_body).encode('utf-8')
-    req = urllib.request.Request(API_URL, data=data, headers=headers, method='POST')
-    
-    with urllib.request.urlopen(req, timeout=120) as response:
-        response_body = response.read().decode('utf-8')
-        result = json.loads(response_body)
-        
-        # Check for API errors in response
-        if "error" in result:
-            raise Exception(f"OpenRouter error: {result['error']}")
-        
-        if "choices" not in result or len(result["choices"]) == 0:
-            raise Exception(f"No choices in response: {response_body[:500]}")
-        
-        message = result["choices"][0]["message"]
-        content = message.get("content", "")
+
+    def process(self, data: dict) -> dict:
+        """Generate a filter from quiz answers"""
+        quiz_results = data.get("quizResults", [])
+        questions = data.get("questions", [])
         
-        # For reasoning models, content might be in reasoning_details
-        if not content and "reasoning_details" in message:
-            # Extract from reasoning if content is empty
-            reasoning = message.get("reasoning_details", [])
-            if reasoning and len(reasoning) > 0:
-                # Get the last reasoning block's content
-                content = reasoning[-1].get("content", "")
+        if not quiz_results or not questions:
+            raise RequestError(400, "Missing quizResults or questions")
         
-        # Also check for reasoning field directly
-        if not content and "reasoning" in message:
-            content = message.get("reasoning", "")
+        # Build prompt; identical answers reuse the cached filter
+        prompt = build_prompt(quiz_results, questions)
+        key = cache_key(prompt)
+        filter_params = CACHE.get(key)
         
-        if not content:
-            raise Exception(f"Empty content in response. Full response: {json.dumps(result)[:1000]}")
+        if filter_params is None:
+            # Concurrent requests for the same prompt share one upstream call
+            filter_params = coalesce(key, generate_filter, prompt, key)
         
-        return content
-
-
-class handler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        """Return API info for browser visits"""
-        self.send_response(200)
-        self.send_header("Content-Type", "application/json")
-        self.send_header("Access-Control-Allow-Origin", "*")
-        self.end_headers()
-        info = {
-            "endpoint": "/api/generate-filter",
-            "method": "POST",
-            "description": "Generate photo filter parameters from quiz answers",
-            "body": {
-                "quizResults": "[{questionId, answer}]",
-                "questions": "[{text, options: [{value, label, description}]}]"
-            }
-        }
-        self.wfile.write(json.dumps(info, indent=2).encode())
-
-    def do_POST(self):
-        try:
-            # Get API key from environment
-            api_key = os.environ.get("OPENROUTER_API_KEY")
-            if not api_key:
-                self.send_error_response(500, "OPENROUTER_API_KEY not set in environment variables")
-                return
-            
-            if len(api_key) < 10:
-                self.send_error_response(500, f"API key appears invalid (length: {len(api_key)})")
-                return
-            
-            # Parse request body
-            content_length = int(self.headers.get("Content-Length", 0))
-            body = self.rfile.read(content_length)
-            data = json.loads(body)
-            
-            quiz_results = data.get("quizResults", [])
-            questions = data.get("questions", [])
-            
-            if not quiz_results or not questions:
-                self.send_error_response(400, "Missing quizResults or questions")
-                return
-            
-            # Build prompt and call API
-            prompt = build_prompt(quiz_results, questions)
-            gpt_response = call_openrouter(prompt, api_key)
-            
-            # Parse and validate response
-            filter_params = parse_response(gpt_response)
-            
-            # Send success response
-            self.send_response(200)
-            self.send_header("Content-Type", "application/json")
-            self.send_header("Access-Control-Allow-Origin", "*")
-            self.end_headers()
-            self.wfile.write(json.dumps({"success": True, "filter": filter_params}).encode())
-            
-        except urllib.error.HTTPError as e:
-            error_body = e.read().decode('utf-8')
-            try:
-                error_data = json.loads(error_body)
-                message = error_data.get("error", {}).get("message", str(e))
-            except:
-                message = f"HTTP {e.code}: {error_body[:200]}"
-            self.send_error_response(e.code, message)
-        except urllib.error.URLError as e:
-            self.send_error_response(500, f"Network error: {str(e)}")
-        except json.JSONDecodeError as e:
-            self.send_error_response(400, f"Invalid JSON: {str(e)}")
-        except Exception as e:
-            self.send_error_response(500, f"Server error: {str(e)}")
-    
-    def do_OPTIONS(self):
-        """Handle CORS preflight"""
-        self.send_response(200)
-        self.send_header("Access-Control-Allow-Origin", "*")
-        self.send_header("Access-Control-Allow-Methods", "POST, OPTIONS")
-        self.send_header("Access-Control-Allow-Headers", "Content-Type")
-        self.end_headers()
-    
-    def send_error_response(self, status_code: int, message: str):
-        self.send_response(status_code)
-        self.send_header("Content-Type", "application/json")
-        self.send_header("Access-Control-Allow-Origin", "*")
-        self.end_headers()
-        self.wfile.write(json.dumps({"success": False, "error": message}).encode())
+        return {"success": True, "filter": filter_params}
@@ -3,49 +3,28 @@ Match Style API - Vercel Serverless Function
 Analyzes a reference image and adjusts filter parameters to match its style using GPT-4o Vision
 """
 
-from http.server import BaseHTTPRequestHandler
+import base64
+import binascii
+import hashlib
 import json
 import os
-import urllib.request
-import urllib.error
+import re
+import sys
 
-# OpenRouter API configuration
-API_URL = "https://openrouter.ai/api/v1/chat/completions"
-MODEL = "google/gemini-3-pro-preview"
+# Shared helpers live alongside the endpoints in api/_common.py
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from _common import DEFAULT_PARAMS, MODEL, PARAMS_JSON_TEMPLATE, PARAMS_LIST_TEMPLATE, BaseHandler, LRUCache, RequestError, cache_key, clamp_params, coalesce, json_dumps, normalize_params, parse_response, request_completion
 
-# Parameter ranges for validation - expanded for more creative freedom
-RANGES = {
-    "brightness": {"min": 0.6, "max": 1.5},
-    "contrast": {"min": 0.6, "max": 1.5},
-    "saturation": {"min": 0.3, "max": 1.8},
-    "temperature": {"min": -40, "max": 40},
-    "tint": {"min": -25, "max": 25},
-    "grain": {"min": 0, "max": 0.4},
-    "vignette": {"min": 0, "max": 0.6},
-    "fade": {"min": 0, "max": 0.35}
-}
+# Style matches already computed on this warm container, keyed by image content + params hash
+CACHE = LRUCache(2048)
 
-
-def clamp_value(value, range_def):
-    """Clamp value to valid range"""
-    if not isinstance(value, (int, float)) or value != value:
-        return (range_def["min"] + range_def["max"]) / 2
-    return max(range_def["min"], min(range_def["max"], value))
-
-
-def build_vision_prompt(current_params: dict) -> str:
-    """Build prompt for image style matching"""
-    return f"""Analyze this reference image's color grading, mood, and visual style. Then ADJUST the user's current filter to incorporate elements of this style.
+# Static prompt text around the two per-request parameter blocks
+VISION_PROMPT_HEAD = """Analyze this reference image's color grading, mood, and visual style. Then ADJUST the user's current filter to incorporate elements of this style.
 
 CURRENT FILTER PARAMETERS (starting point):
-- brightness: {current_params.get('brightness', 1.0)}
-- contrast: {current_params.get('contrast', 1.0)}
-- saturation: {current_params.get('saturation', 1.0)}
-- temperature: {current_params.get('temperature', 0)}
-- tint: {current_params.get('tint', 0)}
-- grain: {current_params.get('grain', 0)}
-- vignette: {current_params.get('vignette', 0)}
-- fade: {current_params.get('fade', 0)}
+"""
+
+VISION_PROMPT_BODY = """
 
 Analyze the reference image for:
 - Overall brightness and exposure
@@ -71,203 +50,136 @@ Parameter ranges (use full range when appropriate):
 - fade: 0 to 0.35
 
 Respond ONLY with valid JSON:
-{{
-  "brightness": {current_params.get('brightness', 1.0)},
-  "contrast": {current_params.get('contrast', 1.0)},
-  "saturation": {current_params.get('saturation', 1.0)},
-  "temperature": {current_params.get('temperature', 0)},
-  "tint": {current_params.get('tint', 0)},
-  "grain": {current_params.get('grain', 0)},
-  "vignette": {current_params.get('vignette', 0)},
-  "fade": {current_params.get('fade', 0)}
-}}"""
+"""
 
 
-def parse_response(response_text: str) -> dict:
-    """Parse and validate GPT response"""
-    if not response_text or not response_text.strip():
-        raise Exception("Empty response text received")
-    
-    cleaned = response_text.strip()
-    if cleaned.startswith("```"):
-        cleaned = cleaned.replace("```json", "").replace("```", "").strip()
-    
-    # Try to extract JSON from the response if it contains other text
-    if not cleaned.startswith("{"):
-        start = cleaned.find("{")
-        end = cleaned.rfind("}") + 1
-        if start != -1 and end > start:
-            cleaned = cleaned[start:end]
-        else:
-            raise Exception(f"No JSON object found in response: {response_text[:500]}")
+def build_vision_prompt(current_params: dict) -> str:
+    """Build prompt for image style matching"""
+    params = normalize_params(current_params)
+    return "".join((
+        VISION_PROMPT_HEAD,
+        PARAMS_LIST_TEMPLATE.format_map(params),
+        VISION_PROMPT_BODY,
+        PARAMS_JSON_TEMPLATE.format_map(params)
+    ))
+
+
+# Header of an uploaded image data URL, capturing the media type
+DATA_URL_PREFIX = re.compile(r"data:(image/[\w.+-]+);base64")
+
+# Vision request body serialized once at import; the prompt and image URL are spliced in at the nulls
+VISION_REQUEST_HEAD, VISION_REQUEST_MID, VISION_REQUEST_TAIL = json.dumps({
+    "model": MODEL,
+    "messages": [
+        {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": None},
+                {"type": "image_url", "image_url": {"url": None}}
+            ]
+        }
+    ],
+    "temperature": 0,
+    "max_tokens": 500,
+    "response_format": {"type": "json_object"},
+    "provider": {"sort": "latency"},
+    "transforms": [],
+    "reasoning": {"effort": "low"},
+    "stream": True
+}).encode('utf-8').split(b"null")
+
+# The image URL is spliced in between its quotes so its bytes can be used as-is
+VISION_REQUEST_MID += b'"'
+VISION_REQUEST_TAIL = b'"' + VISION_REQUEST_TAIL
+
+
+def encode_image_url(image_url: str) -> tuple:
+    """Validate a base64 image data URL; return the image's SHA-256 and the canonical URL bytes"""
+    if not isinstance(image_url, str):
+        raise ValueError("expected a data:image/...;base64 URL")
+    prefix, comma, payload = image_url.strip().partition(",")
+    match = DATA_URL_PREFIX.fullmatch(prefix)
+    if not comma or not match:
+        raise ValueError("expected a data:image/...;base64 URL")
     
+    # Base64 is ASCII, so the bytes drop into the JSON body without escaping
+    payload = payload.encode('ascii')
     try:
-        parsed = json.loads(cleaned)
-    except json.JSONDecodeError as e:
-        raise Exception(f"JSON parse error: {e}. Content: {cleaned[:500]}")
+        raw = base64.b64decode(payload, validate=True)
+    except binascii.Error:
+        # Allow line-wrapped base64 by dropping the whitespace once
+        payload = b"".join(payload.split())
+        raw = base64.b64decode(payload, validate=True)
     
-    return {
-        "brightness": round(clamp_value(parsed.get("brightness", 1.0), RANGES["brightness"]), 2),
-        "contrast": round(clamp_value(parsed.get("contrast", 1.0), RANGES["contrast"]), 2),
-        "saturation": round(clamp_value(parsed.get("saturation", 1.0), RANGES["saturation"]), 2),
-        "temperature": round(clamp_value(parsed.get("temperature", 0), RANGES["temperature"])),
-        "tint": round(clamp_value(parsed.get("tint", 0), RANGES["tint"])),
-        "grain": round(clamp_value(parsed.get("grain", 0), RANGES["grain"]), 3),
-        "vignette": round(clamp_value(parsed.get("vignette", 0), RANGES["vignette"]), 2),
-        "fade": round(clamp_value(parsed.get("fade", 0), RANGES["fade"]), 3)
-    }
+    digest = hashlib.sha256(raw).digest()
+    return digest, b"data:" + match.group(1).encode('ascii') + b";base64," + payload
+
+
+def call_openrouter_vision(prompt: str, image_url) -> str:
+    """Call OpenRouter API with vision over the pooled connection"""
+    # Join once so the (possibly multi-MB) image is copied a single time
+    data = b"".join((
+        VISION_REQUEST_HEAD,
+        json_dumps(prompt),
+        VISION_REQUEST_MID,
+        image_url,
+        VISION_REQUEST_TAIL
+    ))
+    
+    return request_completion(data)
 
 
-def call_openrouter_vision(prompt: str, base64_image: str, api_key: str) -> str:
-    """Call OpenRouter API with vision using urllib"""
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {api_key}",
-        "HTTP-Referer": "https://vidna.vercel.app",
-        "X-Title": "VIDNA - Photo Filter App"
-    }
-    
-    data = json.dumps({
-        "model": MODEL,
-        "messages": [
-            {
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": prompt},
-                    {"type": "image_url", "image_url": {"url": base64_image}}
-                ]
-            }
-        ],
-        "temperature": 0.3,
-        "max_tokens": 500,
-        "reasoning": {"effort": "low"}
-    }).encode('utf-8')
+def match_style(current_params: dict, image_url, key: str) -> dict:
+    """Call the vision model for an image and cache the validated params"""
+    # Build prompt and call API
+    prompt = build_vision_prompt(current_params)
+    gpt_response = call_openrouter_vision(prompt, image_url)
     
-    req = urllib.request.Request(API_URL, data=data, headers=headers, method='POST')
+    # Parse and validate response
+    new_params = parse_response(gpt_response)
+    CACHE.put(key, new_params)
+    return new_params
+
+
+class handler(BaseHandler):
+    INFO = {
+        "endpoint": "/api/match-style",
+        "method": "POST",
+        "description": "Match filter to reference image style using AI vision",
+        "body": {
+            "currentParams": "{brightness, contrast, ...} (optional)",
+            "image": "data:image/jpeg;base64,..."
+        }
+    }
     
-    with urllib.request.urlopen(req, timeout=120) as response:
-        response_body = response.read().decode('utf-8')
-        result = json.loads(response_body)
-        
-        if "error" in result:
-            raise Exception(f"OpenRouter error: {result['error']}")
+    # Overlap the OpenRouter handshake with reading and encoding the image
+    PRECONNECT = True
+
+    def process(self, data: dict) -> dict:
+        """Blend a reference image's style into the current filter"""
+        current_params = data.get("currentParams", {})
+        base64_image = data.pop("image", "")
         
-        if "choices" not in result or len(result["choices"]) == 0:
-            raise Exception(f"No choices in response: {response_body[:500]}")
+        if not base64_image:
+            raise RequestError(400, "Missing image")
         
-        message = result["choices"][0]["message"]
-        content = message.get("content", "")
+        # Validate once and hold a single encoded copy of the image for the request body
+        try:
+            image_hash, image_url = encode_image_url(base64_image)
+        except ValueError as e:
+            raise RequestError(400, f"Invalid image: {e}")
+        del base64_image
         
-        # For reasoning models, content might be in reasoning_details
-        if not content and "reasoning_details" in message:
-            reasoning = message.get("reasoning_details", [])
-            if reasoning and len(reasoning) > 0:
-                content = reasoning[-1].get("content", "")
+        # Default params if none provided
+        if not current_params:
+            current_params = DEFAULT_PARAMS
         
-        if not content and "reasoning" in message:
-            content = message.get("reasoning", "")
+        # Repeat uploads with the same params (quantized to their output precision) reuse the cached match
+        key = cache_key(image_hash, *clamp_params(current_params).values())
+        new_params = CACHE.get(key)
         
-        if not content:
-            raise Exception(f"Empty content. Response: {json.dumps(result)[:1000]}")
+        if new_params is None:
+            # Concurrent uploads of the same image share one upstream call
+            new_params = coalesce(key, match_style, current_params, image_url, key)
         
-        return content
-
-
-class handler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        """Return API info for browser visits"""
-        self.send_response(200)
-        self.send_header("Content-Type", "application/json")
-        self.send_header("Access-Control-Allow-Origin", "*")
-        self.end_headers()
-        info = {
-            "endpoint": "/api/match-style",
-            "method": "POST",
-            "description": "Match filter to reference image style using AI vision",
-            "body": {
-                "currentParams": "{brightness, contrast, ...} (optional)",
-                "image": "data:image/jpeg;base64,..."
-            }
-        }
-        self.wfile.write(json.dumps(info, indent=2).encode())
-
-    def do_POST(self):
-        try:
-            # Get API key from environment
-            api_key = os.environ.get("OPENROUTER_API_KEY")
-            if not api_key:
-                self.send_error_response(500, "OPENROUTER_API_KEY not set in environment variables")
-                return
-            
-            if len(api_key) < 10:
-                self.send_error_response(500, f"API key appears invalid (length: {len(api_key)})")
-                return
-            
-            # Parse request body
-            content_length = int(self.headers.get("Content-Length", 0))
-            body = self.rfile.read(content_length)
-            data = json.loads(body)
-            
-            current_params = data.get("currentParams", {})
-            base64_image = data.get("image", "")
-            
-            if not base64_image:
-                self.send_error_response(400, "Missing image")
-                return
-            
-            # Default params if none provided
-            if not current_params:
-                current_params = {
-                    "brightness": 1.0,
-                    "contrast": 1.0,
-                    "saturation": 1.0,
-                    "temperature": 0,
-                    "tint": 0,
-                    "grain": 0,
-                    "vignette": 0,
-                    "fade": 0
-                }
-            
-            # Build prompt and call API
-            prompt = build_vision_prompt(current_params)
-            gpt_response = call_openrouter_vision(prompt, base64_image, api_key)
-            
-            # Parse and validate response
-            new_params = parse_response(gpt_response)
-            
-            # Send success response
-            self.send_response(200)
-            self.send_header("Content-Type", "application/json")
-            self.send_header("Access-Control-Allow-Origin", "*")
-            self.end_headers()
-            self.wfile.write(json.dumps({"success": True, "params": new_params}).encode())
-            
-        except urllib.error.HTTPError as e:
-            error_body = e.read().decode('utf-8')
-            try:
-                error_data = json.loads(error_body)
-                message = error_data.get("error", {}).get("message", str(e))
-            except:
-                message = f"HTTP {e.code}: {error_body[:200]}"
-            self.send_error_response(e.code, message)
-        except urllib.error.URLError as e:
-            self.send_error_response(500, f"Network error: {str(e)}")
-        except json.JSONDecodeError as e:
-            self.send_error_response(400, f"Invalid JSON: {str(e)}")
-        except Exception as e:
-            self.send_error_response(500, f"Server error: {str(e)}")
-    
-    def do_OPTIONS(self):
-        """Handle CORS preflight"""
-        self.send_response(200)
-        self.send_header("Access-Control-Allow-Origin", "*")
-        self.send_header("Access-Control-Allow-Methods", "POST, OPTIONS")
-        self.send_header("Access-Control-Allow-Headers", "Content-Type")
-        self.end_headers()
-    
-    def send_error_response(self, status_code: int, message: str):
-        self.send_response(status_code)
-        self.send_header("Content-Type", "application/json")
-        self.send_header("Access-Control-Allow-Origin", "*")
-        self.end_headers()
-        self.wfile.write(json.dumps({"success": False, "error": message}).encode())
+        return {"success": True, "params": new_params}
@@ -3,53 +3,24 @@ Refine Filter API - Vercel Serverless Function
 Adjusts existing filter parameters based on text instructions using GPT-4o
 """
 
-from http.server import BaseHTTPRequestHandler
 import json
 import os
-import urllib.request
-import urllib.error
-
-# OpenRouter API configuration
-API_URL = "https://openrouter.ai/api/v1/chat/completions"
-MODEL = "google/gemini-3-pro-preview"
-
-# Parameter ranges for validation - expanded for more creative freedom
-RANGES = {
-    "brightness": {"min": 0.6, "max": 1.5},
-    "contrast": {"min": 0.6, "max": 1.5},
-    "saturation": {"min": 0.3, "max": 1.8},
-    "temperature": {"min": -40, "max": 40},
-    "tint": {"min": -25, "max": 25},
-    "grain": {"min": 0, "max": 0.4},
-    "vignette": {"min": 0, "max": 0.6},
-    "fade": {"min": 0, "max": 0.35}
-}
+import re
+import sys
 
+# Shared helpers live alongside the endpoints in api/_common.py
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from _common import MODEL, PARAMS_JSON_TEMPLATE, PARAMS_LIST_TEMPLATE, PARAMS_SCHEMA, BaseHandler, DiskCache, LRUCache, RequestError, cache_key, clamp_params, coalesce, json_dumps, normalize_params, parse_response, request_completion
 
-def clamp_value(value, range_def):
-    """Clamp value to valid range"""
-    if not isinstance(value, (int, float)) or value != value:
-        return (range_def["min"] + range_def["max"]) / 2
-    return max(range_def["min"], min(range_def["max"], value))
+# Refinements already computed on this warm container, keyed by quantized params + normalized instruction
+CACHE = LRUCache(1024)
+# Refinements shared across cold starts on the same host; decisions are stable, so keep them a week
+DISK_CACHE = DiskCache("refine", 7 * 24 * 3600, 2000)
 
+# Invariant instructions, sent first as a cacheable system message
+REFINE_SYSTEM_PROMPT = """You are a photo filter expert. The user has an existing filter and wants to ADJUST it based on their feedback.
 
-def build_refine_prompt(current_params: dict, instruction: str) -> str:
-    """Build prompt for filter refinement"""
-    return f"""You are a photo filter expert. The user has an existing filter and wants to ADJUST it based on their feedback.
-
-CURRENT FILTER PARAMETERS (these are the starting point):
-- brightness: {current_params.get('brightness', 1.0)}
-- contrast: {current_params.get('contrast', 1.0)}
-- saturation: {current_params.get('saturation', 1.0)}
-- temperature: {current_params.get('temperature', 0)}
-- tint: {current_params.get('tint', 0)}
-- grain: {current_params.get('grain', 0)}
-- vignette: {current_params.get('vignette', 0)}
-- fade: {current_params.get('fade', 0)}
-
-USER'S ADJUSTMENT REQUEST: "{instruction}"
-
-IMPORTANT: Make INCREMENTAL adjustments to the CURRENT values above. Do NOT start from scratch.
+IMPORTANT: Make INCREMENTAL adjustments to the CURRENT values the user gives. Do NOT start from scratch.
 - If they say "warmer", ADD to the current temperature
 - If they say "more contrast", INCREASE from current
 - Only change parameters relevant to their request
@@ -57,7 +28,7 @@ IMPORTANT: Make INCREMENTAL adjustments to the CURRENT values above. Do NOT star
 
 Parameter ranges (use full range when appropriate):
 - brightness: 0.6 to 1.5
-- contrast: 0.6 to 1.5  
+- contrast: 0.6 to 1.5
 - saturation: 0.3 to 1.8
 - temperature: -40 to +40
 - tint: -25 to +25
@@ -65,183 +36,183 @@ Parameter ranges (use full range when appropriate):
 - vignette: 0 to 0.6
 - fade: 0 to 0.35
 
-Respond ONLY with valid JSON:
-{{
-  "brightness": {current_params.get('brightness', 1.0)},
-  "contrast": {current_params.get('contrast', 1.0)},
-  "saturation": {current_params.get('saturation', 1.0)},
-  "temperature": {current_params.get('temperature', 0)},
-  "tint": {current_params.get('tint', 0)},
-  "grain": {current_params.get('grain', 0)},
-  "vignette": {current_params.get('vignette', 0)},
-  "fade": {current_params.get('fade', 0)}
-}}"""
-
-
-def parse_response(response_text: str) -> dict:
-    """Parse and validate GPT response"""
-    if not response_text or not response_text.strip():
-        raise Exception("Empty response text received")
-    
-    cleaned = response_text.strip()
-    if cleaned.startswith("```"):
-        cleaned = cleaned.replace("```json", "").replace("```", "").strip()
-    
-    # Try to extract JSON from the response if it contains other text
-    if not cleaned.startswith("{"):
-        start = cleaned.find("{")
-        end = cleaned.rfind("}") + 1
-        if start != -1 and end > start:
-            cleaned = cleaned[start:end]
-        else:
-            raise Exception(f"No JSON object found in response: {response_text[:500]}")
-    
-    try:
-        parsed = json.loads(cleaned)
-    except json.JSONDecodeError as e:
-        raise Exception(f"JSON parse error: {e}. Content: {cleaned[:500]}")
-    
-    return {
-        "brightness": round(clamp_value(parsed.get("brightness", 1.0), RANGES["brightness"]), 2),
-        "contrast": round(clamp_value(parsed.get("contrast", 1.0), RANGES["contrast"]), 2),
-        "saturation": round(clamp_value(parsed.get("saturation", 1.0), RANGES["saturation"]), 2),
-        "temperature": round(clamp_value(parsed.get("temperature", 0), RANGES["temperature"])),
-        "tint": round(clamp_value(parsed.get("tint", 0), RANGES["tint"])),
-        "grain": round(clamp_value(parsed.get("grain", 0), RANGES["grain"]), 3),
-        "vignette": round(clamp_value(parsed.get("vignette", 0), RANGES["vignette"]), 2),
-        "fade": round(clamp_value(parsed.get("fade", 0), RANGES["fade"]), 3)
-    }
+Respond ONLY with valid JSON containing all eight parameters."""
 
+REFINE_SYSTEM_MESSAGE = {
+    "role": "system",
+    "content": [{"type": "text", "text": REFINE_SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"}}]
+}
 
-def call_openrouter(prompt: str, api_key: str) -> str:
-    """Call OpenRouter API using urllib"""
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {api_key}",
-        "HTTP-Referer": "https://vidna.vercel.app",
-        "X-Title": "VIDNA - Photo Filter App"
-    }
-    
-    data = json.dumps({
-        "model": MODEL,
-        "messages": [{"role": "user", "content": prompt}],
-        "temperature": 0.3,
-        "max_tokens": 500,
-        "reasoning": {"effort": "low"}
-    }).encode('utf-8')
+
+def build_refine_prompt(current_params: dict, instruction: str) -> str:
+    """Build the per-request part of the refine prompt"""
+    params = normalize_params(current_params)
+    return "".join((
+        "CURRENT FILTER PARAMETERS (these are the starting point):\n",
+        PARAMS_LIST_TEMPLATE.format_map(params),
+        f'\n\nUSER\'S ADJUSTMENT REQUEST: "{instruction}"\n\nRespond ONLY with valid JSON:\n',
+        PARAMS_JSON_TEMPLATE.format_map(params)
+    ))
+
+
+# Wording that doesn't change an instruction's meaning, e.g. "Please make it ..." or "... please!"
+INSTRUCTION_FILLER = re.compile(r"^(?:please )?(?:make it )?|(?: please)?[ .!]*$")
+
+
+def normalize_instruction(instruction) -> str:
+    """Lowercase, collapse whitespace and drop filler so rewordings share a cache entry"""
+    return INSTRUCTION_FILLER.sub("", " ".join(str(instruction).lower().split()))
+
+
+# Single-axis nudges applied directly instead of asking the model: phrase -> (field, delta)
+QUICK_ADJUSTMENTS = {
+    "warmer": ("temperature", 8),
+    "more warm": ("temperature", 8),
+    "cooler": ("temperature", -8),
+    "colder": ("temperature", -8),
+    "more cool": ("temperature", -8),
+    "brighter": ("brightness", 0.1),
+    "lighter": ("brightness", 0.1),
+    "darker": ("brightness", -0.1),
+    "more contrast": ("contrast", 0.1),
+    "increase contrast": ("contrast", 0.1),
+    "punchier": ("contrast", 0.1),
+    "less contrast": ("contrast", -0.1),
+    "reduce contrast": ("contrast", -0.1),
+    "flatter": ("contrast", -0.1),
+    "more saturated": ("saturation", 0.15),
+    "more saturation": ("saturation", 0.15),
+    "more vivid": ("saturation", 0.15),
+    "more colorful": ("saturation", 0.15),
+    "less saturated": ("saturation", -0.15),
+    "less saturation": ("saturation", -0.15),
+    "more muted": ("saturation", -0.15),
+    "more magenta": ("tint", 5),
+    "pinker": ("tint", 5),
+    "more green": ("tint", -5),
+    "greener": ("tint", -5),
+    "more grain": ("grain", 0.05),
+    "grainier": ("grain", 0.05),
+    "add grain": ("grain", 0.05),
+    "less grain": ("grain", -0.05),
+    "reduce grain": ("grain", -0.05),
+    "more vignette": ("vignette", 0.1),
+    "add vignette": ("vignette", 0.1),
+    "less vignette": ("vignette", -0.1),
+    "reduce vignette": ("vignette", -0.1),
+    "more faded": ("fade", 0.05),
+    "more fade": ("fade", 0.05),
+    "less faded": ("fade", -0.05),
+    "less fade": ("fade", -0.05)
+}
+
+# Scale applied to a nudge by an intensity word in front of it
+QUICK_INTENSITY = {
+    None: 1,
+    "a bit": 0.5,
+    "a little": 0.5,
+    "slightly": 0.5,
+    "much": 2,
+    "a lot": 2,
+    "way": 2
+}
+
+# One clause of a normalized instruction, e.g. "a bit warmer" or "much more contrast"
+QUICK_PATTERN = re.compile(
+    r"(?:make it )?"
+    r"(?:(?P<intensity>" + "|".join(word for word in QUICK_INTENSITY if word) + r") )?"
+    r"(?P<phrase>" + "|".join(QUICK_ADJUSTMENTS) + r")"
+)
+
+# Separates the clauses of a compound instruction like "warmer, and more contrast"
+QUICK_SEPARATOR = re.compile(r"(?: ?(?:,|;|&|\band\b) ?)+")
+
+
+def quick_refine(current_params: dict, instruction: str):
+    """Apply known nudge phrases locally, or return None if the model is needed"""
+    adjustments = []
+    for clause in QUICK_SEPARATOR.split(normalize_instruction(instruction)):
+        match = QUICK_PATTERN.fullmatch(clause)
+        if not match:
+            return None
+        field, delta = QUICK_ADJUSTMENTS[match.group("phrase")]
+        adjustments.append((field, delta * QUICK_INTENSITY[match.group("intensity")]))
     
-    req = urllib.request.Request(API_URL, data=data, headers=headers, method='POST')
+    params = clamp_params(current_params)
+    for field, delta in adjustments:
+        params[field] += delta
+    return clamp_params(params)
+
+
+# Request body serialized once at import; the user prompt is spliced in at the null
+REQUEST_HEAD, REQUEST_TAIL = json.dumps({
+    "model": MODEL,
+    "messages": [REFINE_SYSTEM_MESSAGE, {"role": "user", "content": None}],
+    "temperature": 0,
+    "max_tokens": 500,
+    "response_format": {
+        "type": "json_schema",
+        "json_schema": {"name": "filter_params", "strict": True, "schema": PARAMS_SCHEMA}
+    },
+    "reasoning": {"effort": "low"},
+    "stream": True
+}).encode('utf-8').split(b"null")
+
+
+def call_openrouter(prompt: str) -> str:
+    """Call OpenRouter API over the pooled connection, streaming the reply"""
+    data = REQUEST_HEAD + json_dumps(prompt) + REQUEST_TAIL
+    return request_completion(data)
+
+
+def refine_filter(current_params: dict, instruction: str, key: str) -> dict:
+    """Refine from the disk cache or the model, caching the validated params"""
+    new_params = DISK_CACHE.get(key)
     
-    with urllib.request.urlopen(req, timeout=120) as response:
-        response_body = response.read().decode('utf-8')
-        result = json.loads(response_body)
-        
-        if "error" in result:
-            raise Exception(f"OpenRouter error: {result['error']}")
+    if new_params is None:
+        prompt = build_refine_prompt(current_params, instruction)
+        gpt_response = call_openrouter(prompt)
         
-        if "choices" not in result or len(result["choices"]) == 0:
-            raise Exception(f"No choices in response: {response_body[:500]}")
-        
-        message = result["choices"][0]["message"]
-        content = message.get("content", "")
-        
-        # For reasoning models, content might be in reasoning_details
-        if not content and "reasoning_details" in message:
-            reasoning = message.get("reasoning_details", [])
-            if reasoning and len(reasoning) > 0:
-                content = reasoning[-1].get("content", "")
+        # Parse and validate response
+        new_params = parse_response(gpt_response)
+        DISK_CACHE.put(key, new_params)
+    
+    CACHE.put(key, new_params)
+    return new_params
+
+
+class handler(BaseHandler):
+    INFO = {
+        "endpoint": "/api/refine-filter",
+        "method": "POST",
+        "description": "Refine filter parameters based on text instructions",
+        "body": {
+            "currentParams": "{brightness, contrast, saturation, temperature, tint, grain, vignette, fade}",
+            "instruction": "string - e.g. 'make it warmer'"
+        }
+    }
+    # Eight numbers and a short instruction fit well under this
+    MAX_BODY = 4096
+
+    def process(self, data: dict) -> dict:
+        """Adjust the current filter from a text instruction"""
+        current_params = data.get("currentParams", {})
+        instruction = data.get("instruction", "")
         
-        if not content and "reasoning" in message:
-            content = message.get("reasoning", "")
+        if not current_params or not instruction:
+            raise RequestError(400, "Missing currentParams or instruction")
         
-        if not content:
-            raise Exception(f"Empty content. Response: {json.dumps(result)[:1000]}")
+        # Simple nudges like "warmer" skip the model entirely
+        new_params = quick_refine(current_params, instruction)
         
-        return content
-
-
-class handler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        """Return API info for browser visits"""
-        self.send_response(200)
-        self.send_header("Content-Type", "application/json")
-        self.send_header("Access-Control-Allow-Origin", "*")
-        self.end_headers()
-        info = {
-            "endpoint": "/api/refine-filter",
-            "method": "POST",
-            "description": "Refine filter parameters based on text instructions",
-            "body": {
-                "currentParams": "{brightness, contrast, saturation, temperature, tint, grain, vignette, fade}",
-                "instruction": "string - e.g. 'make it warmer'"
-            }
-        }
-        self.wfile.write(json.dumps(info, indent=2).encode())
-
-    def do_POST(self):
-        try:
-            # Get API key from environment
-            api_key = os.environ.get("OPENROUTER_API_KEY")
-            if not api_key:
-                self.send_error_response(500, "OPENROUTER_API_KEY not set in environment variables")
-                return
-            
-            if len(api_key) < 10:
-                self.send_error_response(500, f"API key appears invalid (length: {len(api_key)})")
-                return
-            
-            # Parse request body
-            content_length = int(self.headers.get("Content-Length", 0))
-            body = self.rfile.read(content_length)
-            data = json.loads(body)
+        if new_params is None:
+            # Params quantized to their output precision plus the normalized
+            # instruction let near-identical requests reuse the cached result
+            key = cache_key(normalize_instruction(instruction), *clamp_params(current_params).values())
+            new_params = CACHE.get(key)
             
-            current_params = data.get("currentParams", {})
-            instruction = data.get("instruction", "")
-            
-            if not current_params or not instruction:
-                self.send_error_response(400, "Missing currentParams or instruction")
-                return
-            
-            # Build prompt and call API
-            prompt = build_refine_prompt(current_params, instruction)
-            gpt_response = call_openrouter(prompt, api_key)
-            
-            # Parse and validate response
-            new_params = parse_response(gpt_response)
-            
-            # Send success response
-            self.send_response(200)
-            self.send_header("Content-Type", "application/json")
-            self.send_header("Access-Control-Allow-Origin", "*")
-            self.end_headers()
-            self.wfile.write(json.dumps({"success": True, "params": new_params}).encode())
-            
-        except urllib.error.HTTPError as e:
-            error_body = e.read().decode('utf-8')
-            try:
-                error_data = json.loads(error_body)
-                message = error_data.get("error", {}).get("message", str(e))
-            except:
-                message = f"HTTP {e.code}: {error_body[:200]}"
-            self.send_error_response(e.code, message)
-        except urllib.error.URLError as e:
-            self.send_error_response(500, f"Network error: {str(e)}")
-        except json.JSONDecodeError as e:
-            self.send_error_response(400, f"Invalid JSON: {str(e)}")
-        except Exception as e:
-            self.send_error_response(500, f"Server error: {str(e)}")
-    
-    def do_OPTIONS(self):
-        """Handle CORS preflight"""
-        self.send_response(200)
-        self.send_header("Access-Control-Allow-Origin", "*")
-        self.send_header("Access-Control-Allow-Methods", "POST, OPTIONS")
-        self.send_header("Access-Control-Allow-Headers", "Content-Type")
-        self.end_headers()
-    
-    def send_error_response(self, status_code: int, message: str):
-        self.send_response(status_code)
-        self.send_header("Content-Type", "application/json")
-        self.send_header("Access-Control-Allow-Origin", "*")
-        self.end_headers()
-        self.wfile.write(json.dumps({"success": False, "error": message}).encode())
+            if new_params is None:
+                # Concurrent identical refinements share one upstream call
+                new_params = coalesce(key, refine_filter, current_params, instruction, key)
+        
+        return {"success": True, "params": new_params}